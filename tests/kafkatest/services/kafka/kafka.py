@@ -18,7 +18,10 @@ import json
 import os.path
 import re
 import signal
-import time
+import socket
+import threading
+import uuid
+from concurrent import futures
 
 from ducktape.services.service import Service
 from ducktape.utils.util import wait_until
@@ -34,6 +37,9 @@ from kafkatest.version import DEV_BRANCH, LATEST_0_10_0
 
 Port = collections.namedtuple('Port', ['name', 'number', 'open'])
 
+_REASSIGNMENT_FAILED_RE = re.compile(r"Reassignment of partition.*failed", re.DOTALL)
+_REASSIGNMENT_IN_PROGRESS_RE = re.compile(r"is still in progress")
+
 class KafkaService(KafkaPathResolverMixin, JmxMixin, Service):
     PERSISTENT_ROOT = "/mnt/kafka"
     STDOUT_STDERR_CAPTURE = os.path.join(PERSISTENT_ROOT, "server-start-stdout-stderr.log")
@@ -49,6 +55,9 @@ class KafkaService(KafkaPathResolverMixin, JmxMixin, Service):
     CONFIG_FILE = os.path.join(PERSISTENT_ROOT, "kafka.properties")
     # Kafka Authorizer
     SIMPLE_AUTHORIZER = "kafka.security.auth.SimpleAclAuthorizer"
+    # Admin commands such as kafka-topics.sh and zookeeper queries start a JVM on a single shared node, so
+    # keep the number of them running at once small to avoid starving the broker/zookeeper on that node
+    MAX_CONCURRENT_ADMIN_COMMANDS = 2
 
     logs = {
         "kafka_server_start_stdout_stderr": {
@@ -97,6 +106,10 @@ class KafkaService(KafkaPathResolverMixin, JmxMixin, Service):
             self.server_prop_overides = server_prop_overides
         self.log_level = "DEBUG"
         self.zk_chroot = zk_chroot
+        self._bootstrap_servers = {}
+        self._zk_connect_settings = {}
+        # prop_file() stores the listeners of the node being rendered on self
+        self._prop_file_lock = threading.Lock()
 
         #
         # In a heavily loaded and not very fast machine, it is
@@ -158,7 +171,18 @@ class KafkaService(KafkaPathResolverMixin, JmxMixin, Service):
             self.minikdc = None
 
     def alive(self, node):
-        return len(self.pids(node)) > 0
+        """Check whether the broker on the given node accepts TCP connections on its client port.
+
+        This is a port check made from the test driver, not a process check: a broker whose process is
+        running but which is not (yet) listening is reported as not alive. Use pids() to check for the process.
+        """
+        port = self.port_mappings[self.security_protocol].number
+        try:
+            sock = socket.create_connection((node.account.externally_routable_ip, port), timeout=1)
+        except (socket.error, socket.timeout):
+            return False
+        sock.close()
+        return True
 
     def start(self, add_principals=""):
         self.open_port(self.security_protocol)
@@ -173,19 +197,32 @@ class KafkaService(KafkaPathResolverMixin, JmxMixin, Service):
 
         retries = 30
         expected_broker_ids = set(self.nodes)
-        wait_until(lambda: {node for node in self.nodes if self.is_registered(node)} == expected_broker_ids, 30, 1)
+        # Only re-query the brokers which have not been seen registered yet
+        registered = set()
+
+        def all_registered():
+            registered.update(self.registered_nodes(expected_broker_ids - registered))
+            return registered == expected_broker_ids
+
+        wait_until(all_registered, 30, 1)
 
         if retries == 0:
             raise RuntimeError("Kafka servers didn't register at ZK within 30 seconds")
 
         # Create topics if necessary
         if self.topics is not None:
+            topic_cfgs = []
             for topic, topic_cfg in self.topics.items():
                 if topic_cfg is None:
                     topic_cfg = {}
 
                 topic_cfg["topic"] = topic
-                self.create_topic(topic_cfg)
+                topic_cfgs.append(topic_cfg)
+
+            if topic_cfgs:
+                max_workers = min(KafkaService.MAX_CONCURRENT_ADMIN_COMMANDS, len(topic_cfgs))
+                with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    list(executor.map(self.create_topic, topic_cfgs))
 
     def _ensure_zk_chroot(self):
         self.logger.info("Ensuring zk_chroot %s exists", self.zk_chroot)
@@ -218,12 +255,13 @@ class KafkaService(KafkaPathResolverMixin, JmxMixin, Service):
         for prop in self.server_prop_overides:
             cfg[prop[0]] = prop[1]
 
-        self.set_protocol_and_port(node)
+        with self._prop_file_lock:
+            self.set_protocol_and_port(node)
 
-        # TODO - clean up duplicate configuration logic
-        prop_file = cfg.render()
-        prop_file += self.render('kafka.properties', node=node, broker_id=self.idx(node),
-                                 security_config=self.security_config, num_nodes=self.num_nodes)
+            # TODO - clean up duplicate configuration logic
+            prop_file = cfg.render()
+            prop_file += self.render('kafka.properties', node=node, broker_id=self.idx(node),
+                                     security_config=self.security_config, num_nodes=self.num_nodes)
         return prop_file
 
     def start_cmd(self, node):
@@ -242,7 +280,6 @@ class KafkaService(KafkaPathResolverMixin, JmxMixin, Service):
         prop_file = self.prop_file(node)
         self.logger.info("kafka.properties:")
         self.logger.info(prop_file)
-        node.account.create_file(KafkaService.CONFIG_FILE, prop_file)
         node.account.create_file(self.LOG4J_CONFIG, self.render('log4j.properties', log_dir=KafkaService.OPERATIONAL_LOG_DIR))
 
         self.security_config.setup_node(node)
@@ -250,6 +287,11 @@ class KafkaService(KafkaPathResolverMixin, JmxMixin, Service):
 
         cmd = self.start_cmd(node)
         self.logger.debug("Attempting to start KafkaService on %s with command: %s" % (str(node.account), cmd))
+        # Write the broker config in the same ssh session which starts the broker
+        eof_marker = "KAFKA_PROPERTIES_EOF_%s" % uuid.uuid4().hex
+        if not prop_file.endswith("\n"):
+            prop_file += "\n"
+        cmd = "cat > %s <<'%s'\n%s%s\n%s" % (KafkaService.CONFIG_FILE, eof_marker, prop_file, eof_marker, cmd)
         with node.account.monitor_log(KafkaService.STDOUT_STDERR_CAPTURE) as monitor:
             node.account.ssh(cmd)
             # Kafka 1.0.0 and higher don't have a space between "Kafka" and "Server"
@@ -264,19 +306,26 @@ class KafkaService(KafkaPathResolverMixin, JmxMixin, Service):
         if len(self.pids(node)) == 0:
             raise Exception("No process ids recorded on node %s" % node.account.hostname)
 
+    def pids_cmd(self):
+        """Return a shell command which prints the process ids of the brokers running on a node, one per line."""
+        return "jcmd | grep -e %s | awk '{print $1}'" % self.java_class_name()
+
     def pids(self, node):
         """Return process ids associated with running processes on the given node."""
         try:
-            cmd = "jcmd | grep -e %s | awk '{print $1}'" % self.java_class_name()
-            pid_arr = [pid for pid in node.account.ssh_capture(cmd, allow_fail=True, callback=int)]
-            return pid_arr
+            cmd = self.pids_cmd()
+            output = "".join(node.account.ssh_capture(cmd, allow_fail=True))
+            return [int(pid) for pid in output.split()]
         except (RemoteCommandError, ValueError) as e:
             return []
 
+    def _signal_pids(self, node, pids, sig, allow_fail=False):
+        """Deliver the signal to all the given pids on the node with a single remote kill."""
+        if pids:
+            node.account.ssh("kill -%d %s" % (sig, " ".join(str(pid) for pid in pids)), allow_fail=allow_fail)
+
     def signal_node(self, node, sig=signal.SIGTERM):
-        pids = self.pids(node)
-        for pid in pids:
-            node.account.signal(pid, sig)
+        self._signal_pids(node, self.pids(node), sig)
 
     def signal_leader(self, topic, partition=0, sig=signal.SIGTERM):
         leader = self.leader(topic, partition)
@@ -286,8 +335,7 @@ class KafkaService(KafkaPathResolverMixin, JmxMixin, Service):
         pids = self.pids(node)
         sig = signal.SIGTERM if clean_shutdown else signal.SIGKILL
 
-        for pid in pids:
-            node.account.signal(pid, sig, allow_fail=False)
+        self._signal_pids(node, pids, sig, allow_fail=False)
 
         try:
             wait_until(lambda: len(self.pids(node)) == 0, timeout_sec=60, err_msg="Kafka node failed to stop")
@@ -296,18 +344,18 @@ class KafkaService(KafkaPathResolverMixin, JmxMixin, Service):
             raise
 
     def thread_dump(self, node):
-        for pid in self.pids(node):
-            try:
-                node.account.signal(pid, signal.SIGQUIT, allow_fail=True)
-            except:
-                self.logger.warn("Could not dump threads on node")
+        try:
+            self._signal_pids(node, self.pids(node), signal.SIGQUIT, allow_fail=True)
+        except:
+            self.logger.warn("Could not dump threads on node")
 
     def clean_node(self, node):
         JmxMixin.clean_node(self, node)
         self.security_config.clean_node(node)
-        node.account.kill_java_processes(self.java_class_name(),
-                                         clean_shutdown=False, allow_fail=True)
-        node.account.ssh("sudo rm -rf -- %s" % KafkaService.PERSISTENT_ROOT, allow_fail=False)
+        # Kill any remaining broker and remove its files in a single ssh session
+        cmd = "%s | xargs -r kill -%d; " % (self.pids_cmd(), signal.SIGKILL)
+        cmd += "sudo rm -rf -- %s" % KafkaService.PERSISTENT_ROOT
+        node.account.ssh(cmd, allow_fail=False)
 
     def create_topic(self, topic_cfg, node=None):
         """Run the admin tool create topic command.
@@ -318,38 +366,41 @@ class KafkaService(KafkaPathResolverMixin, JmxMixin, Service):
         """
         if node is None:
             node = self.nodes[0]
-        self.logger.info("Creating topic %s with settings %s",
-                         topic_cfg["topic"], topic_cfg)
+        topic = topic_cfg["topic"]
+        self.logger.info("Creating topic %s with settings %s", topic, topic_cfg)
         kafka_topic_script = self.path.script("kafka-topics.sh", node)
 
-        cmd = kafka_topic_script + " "
-        cmd += "--zookeeper %(zk_connect)s --create --topic %(topic)s " % {
-                'zk_connect': self.zk_connect_setting(),
-                'topic': topic_cfg.get("topic"),
-           }
+        cmd = [kafka_topic_script, "--zookeeper", self.zk_connect_setting(), "--create", "--topic", topic]
         if 'replica-assignment' in topic_cfg:
-            cmd += " --replica-assignment %(replica-assignment)s" % {
-                'replica-assignment': topic_cfg.get('replica-assignment')
-            }
+            cmd += ["--replica-assignment", str(topic_cfg['replica-assignment'])]
         else:
-            cmd += " --partitions %(partitions)d --replication-factor %(replication-factor)d" % {
-                'partitions': topic_cfg.get('partitions', 1),
-                'replication-factor': topic_cfg.get('replication-factor', 1)
-            }
+            cmd += ["--partitions", "%d" % topic_cfg.get('partitions', 1),
+                    "--replication-factor", "%d" % topic_cfg.get('replication-factor', 1)]
 
         if topic_cfg.get('if-not-exists', False):
-            cmd += ' --if-not-exists'
+            cmd.append("--if-not-exists")
 
-        if "configs" in topic_cfg.keys() and topic_cfg["configs"] is not None:
-            for config_name, config_value in topic_cfg["configs"].items():
-                cmd += " --config %s=%s" % (config_name, str(config_value))
+        configs = topic_cfg.get("configs")
+        if configs:
+            cmd += ["--config %s=%s" % (config_name, str(config_value))
+                    for config_name, config_value in configs.items()]
+        cmd = " ".join(cmd)
 
         self.logger.info("Running topic creation command...\n%s" % cmd)
         node.account.ssh(cmd)
 
-        time.sleep(1)
         self.logger.info("Checking to see if topic was properly created...\n%s" % cmd)
-        for line in self.describe_topic(topic_cfg["topic"]).split("\n"):
+        description = [""]
+
+        # The topic shows up in the description as soon as it is created, but its partitions
+        # report "Leader: none" until the controller has elected leaders for them
+        def topic_has_leaders():
+            description[0] = self.describe_topic(topic)
+            return "Leader:" in description[0] and "Leader: none" not in description[0]
+
+        wait_until(topic_has_leaders, timeout_sec=30, backoff_sec=1,
+                   err_msg="Leaders were not elected for all partitions of topic %s" % topic)
+        for line in description[0].split("\n"):
             self.logger.info(line)
 
     def describe_topic(self, topic, node=None):
@@ -357,10 +408,7 @@ class KafkaService(KafkaPathResolverMixin, JmxMixin, Service):
             node = self.nodes[0]
         cmd = "%s --zookeeper %s --topic %s --describe" % \
               (self.path.script("kafka-topics.sh", node), self.zk_connect_setting(), topic)
-        output = ""
-        for line in node.account.ssh_capture(cmd):
-            output += line
-        return output
+        return "".join(node.account.ssh_capture(cmd))
 
     def list_topics(self, topic, node=None):
         if node is None:
@@ -415,38 +463,29 @@ class KafkaService(KafkaPathResolverMixin, JmxMixin, Service):
         if node is None:
             node = self.nodes[0]
 
-        json_file = "/tmp/%s_reassign.json" % str(time.time())
+        json_file = "/tmp/%s_reassign.json" % uuid.uuid4().hex
 
-        # reassignment to json
-        json_str = json.dumps(reassignment)
-        json_str = json.dumps(json_str)
+        # upload reassignment json
+        node.account.create_file(json_file, json.dumps(reassignment))
 
         # create command
-        cmd = "echo %s > %s && " % (json_str, json_file)
-        cmd += "%s " % self.path.script("kafka-reassign-partitions.sh", node)
+        cmd = "%s " % self.path.script("kafka-reassign-partitions.sh", node)
         cmd += "--zookeeper %s " % self.zk_connect_setting()
         cmd += "--reassignment-json-file %s " % json_file
-        cmd += "--verify "
-        cmd += "&& sleep 1 && rm -f %s" % json_file
+        cmd += "--verify"
 
         # send command
         self.logger.info("Verifying parition reassignment...")
         self.logger.debug(cmd)
-        output = ""
-        for line in node.account.ssh_capture(cmd):
-            output += line
+        output = "".join(node.account.ssh_capture(cmd))
+        node.account.ssh("rm -f %s" % json_file, allow_fail=True)
 
         self.logger.debug(output)
 
-        if re.match(".*Reassignment of partition.*failed.*",
-                    output.replace('\n', '')) is not None:
-            return False
-
-        if re.match(".*is still in progress.*",
-                    output.replace('\n', '')) is not None:
+        if _REASSIGNMENT_FAILED_RE.search(output) is not None:
             return False
 
-        return True
+        return _REASSIGNMENT_IN_PROGRESS_RE.search(output) is None
 
     def execute_reassign_partitions(self, reassignment, node=None,
                                     throttle=None):
@@ -454,28 +493,24 @@ class KafkaService(KafkaPathResolverMixin, JmxMixin, Service):
         """
         if node is None:
             node = self.nodes[0]
-        json_file = "/tmp/%s_reassign.json" % str(time.time())
+        json_file = "/tmp/%s_reassign.json" % uuid.uuid4().hex
 
-        # reassignment to json
-        json_str = json.dumps(reassignment)
-        json_str = json.dumps(json_str)
+        # upload reassignment json
+        node.account.create_file(json_file, json.dumps(reassignment))
 
         # create command
-        cmd = "echo %s > %s && " % (json_str, json_file)
-        cmd += "%s " % self.path.script( "kafka-reassign-partitions.sh", node)
+        cmd = "%s " % self.path.script( "kafka-reassign-partitions.sh", node)
         cmd += "--zookeeper %s " % self.zk_connect_setting()
         cmd += "--reassignment-json-file %s " % json_file
         cmd += "--execute"
         if throttle is not None:
             cmd += " --throttle %d" % throttle
-        cmd += " && sleep 1 && rm -f %s" % json_file
 
         # send command
         self.logger.info("Executing parition reassignment...")
         self.logger.debug(cmd)
-        output = ""
-        for line in node.account.ssh_capture(cmd):
-            output += line
+        output = "".join(node.account.ssh_capture(cmd))
+        node.account.ssh("rm -f %s" % json_file, allow_fail=True)
 
         self.logger.debug("Verify partition reassignment:")
         self.logger.debug(output)
@@ -519,6 +554,13 @@ class KafkaService(KafkaPathResolverMixin, JmxMixin, Service):
         self.stop_node(node, clean_shutdown)
         self.start_node(node)
 
+    def restart_nodes(self, nodes, clean_shutdown=True):
+        """Restart the given nodes. All the nodes are stopped concurrently, then all of them are started concurrently."""
+        nodes = list(nodes)
+        with futures.ThreadPoolExecutor(max_workers=max(1, len(nodes))) as executor:
+            list(executor.map(lambda node: self.stop_node(node, clean_shutdown), nodes))
+            list(executor.map(self.start_node, nodes))
+
     def isr_idx_list(self, topic, partition=0):
         """ Get in-sync replica list the given topic and partition.
         """
@@ -633,7 +675,9 @@ class KafkaService(KafkaPathResolverMixin, JmxMixin, Service):
         return output
 
     def zk_connect_setting(self):
-        return self.zk.connect_setting(self.zk_chroot)
+        if self.zk_chroot not in self._zk_connect_settings:
+            self._zk_connect_settings[self.zk_chroot] = self.zk.connect_setting(self.zk_chroot)
+        return self._zk_connect_settings[self.zk_chroot]
 
     def bootstrap_servers(self, protocol='PLAINTEXT', validate=True, offline_nodes=[]):
         """Return comma-delimited list of brokers in this cluster formatted as HOSTNAME1:PORT1,HOSTNAME:PORT2,...
@@ -646,7 +690,13 @@ class KafkaService(KafkaPathResolverMixin, JmxMixin, Service):
         if validate and not port_mapping.open:
             raise ValueError("We are retrieving bootstrap servers for the port: %s which is not currently open. - " % str(port_mapping))
 
-        return ','.join([node.account.hostname + ":" + str(port_mapping.number) for node in self.nodes if node not in offline_nodes])
+        if offline_nodes:
+            return ','.join([node.account.hostname + ":" + str(port_mapping.number) for node in self.nodes if node not in offline_nodes])
+
+        # The broker hostnames and port numbers are fixed for the lifetime of the service
+        if port_mapping.number not in self._bootstrap_servers:
+            self._bootstrap_servers[port_mapping.number] = ','.join([node.account.hostname + ":" + str(port_mapping.number) for node in self.nodes])
+        return self._bootstrap_servers[port_mapping.number]
 
     def controller(self):
         """ Get the controller node
@@ -673,6 +723,17 @@ class KafkaService(KafkaPathResolverMixin, JmxMixin, Service):
         self.logger.debug("Broker info: %s", broker_info)
         return broker_info is not None
 
+    def registered_nodes(self, nodes):
+        """
+        Return the subset of the given nodes which are registered in Zookeeper. The nodes are queried
+        concurrently, at most MAX_CONCURRENT_ADMIN_COMMANDS at a time.
+        """
+        nodes = list(nodes)
+        max_workers = max(1, min(KafkaService.MAX_CONCURRENT_ADMIN_COMMANDS, len(nodes)))
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            registered = list(executor.map(self.is_registered, nodes))
+        return {node for node, is_registered in zip(nodes, registered) if is_registered}
+
     def get_offset_shell(self, topic, partitions, max_wait_ms, offsets, time):
         node = self.nodes[0]
 